@@ -1,15 +1,23 @@
 import os
+import asyncio
 from dotenv import load_dotenv
 from mysql.connector import Error, pooling
-from selenium.common.exceptions import WebDriverException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as ec
-from multiprocessing import Process, Queue
+from multiprocessing import util
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
 import logging
-from openai import OpenAI
+import time
+from queue import Empty, Full, Queue
+from threading import Thread, main_thread
+from openai import AsyncOpenAI
 from contextlib import contextmanager
+from functools import lru_cache
+from html.parser import HTMLParser
+from http.client import HTTPException
+from urllib.request import Request, urlopen
 
 # Настройка логгирования
 logging.basicConfig(
@@ -32,8 +40,13 @@ CONFIG = {
     'DB_NAME': os.getenv('DB_NAME', 'test'),
     'MAX_THREADS': int(os.getenv('MAX_THREADS', 4)),
     'BATCH_SIZE': int(os.getenv('BATCH_SIZE', 400)),
+    'MAX_PAGES_PER_DRIVER': int(os.getenv('MAX_PAGES_PER_DRIVER', 50)),
+    'PAGE_LOAD_TIMEOUT': int(os.getenv('PAGE_LOAD_TIMEOUT', 30)),
     'OPENAI_API_KEY': os.getenv('OPENAI_API_KEY'),
-    'PROXY': os.getenv('PROXY')
+    'OPENAI_MAX_CONCURRENCY': int(os.getenv('OPENAI_MAX_CONCURRENCY', 20)),
+    'PROXY': os.getenv('PROXY'),
+    # Адрес Selenium Grid, без него Chrome запускается локально
+    'SE_GRID_URL': os.getenv('SE_GRID_URL')
 }
 
 # SQL-запрос для обработки строк в БД
@@ -51,6 +64,40 @@ QUERIES = {
     """
 }
 
+# Загрузка страниц без браузера
+STATIC_FETCH = {
+    # TIMEOUT ограничивает одну операцию с сокетом, TOTAL_TIMEOUT - всю загрузку
+    'TIMEOUT': 10,
+    'TOTAL_TIMEOUT': 20,
+    'MAX_BYTES': 5 * 1024 * 1024,
+    'READ_CHUNK': 64 * 1024,
+    'CONTENT_TYPES': {'text/html', 'application/xhtml+xml'},
+    # Меньше текста обычно отдаёт JS-оболочка, такие сайты открываем в Chrome
+    'MIN_TEXT_LENGTH': 500,
+    'MIN_TEXT_BLOCKS': 5,
+    'HEADERS': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                      'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+    }
+}
+
+# Сбор текста div и p внутри браузера
+EXTRACT_TEXT_SCRIPT = """
+    return Array.from(document.querySelectorAll('div, p'))
+        .map(e => e.innerText)
+        .filter(t => t && t.trim())
+        .join(' ');
+"""
+
+# Удаление кавычек из текста за один проход
+QUOTE_TABLE = str.maketrans('', '', '"\'')
+
+# Запись результатов пачками: по размеру или по таймеру (в секундах)
+SAVE_BATCH = {
+    'SIZE': 50,
+    'FLUSH_INTERVAL': 2
+}
+
 # Ключевые слова и данные (для БД)
 KEYWORDS = {
     'basic': ['Description', 'Target Audience', 'Market problems',
@@ -111,19 +158,42 @@ KEYWORDS = {
     ]
 }
 
+# Запрос к ChatGPT собирается один раз при импорте, при вызове подставляется только текст
+PROMPT_BUSINESS_MODELS = ', '.join(KEYWORDS['business_models'])
+PROMPT_INDUSTRIES = ', '.join(KEYWORDS['industries'][:5])
+PROMPT = f"""
+Analyze this company information and provide:
+#Description# - Brief company overview
+#Target Audience# - Who they serve
+#Market Problem# - Problem they solve
+#Product# - Their product/service
+#Business Model# - One of: {PROMPT_BUSINESS_MODELS}
+#Industry# - One of: {PROMPT_INDUSTRIES}...
+Text to analyze: {{text}}"""
+
+
+# Пул соединений создаётся один раз на процесс, при первом обращении.
+# pid в ключе кэша не даёт дочернему процессу унаследовать соединения родителя
+@lru_cache(maxsize=1)
+def get_connection_pool(pid):
+    return pooling.MySQLConnectionPool(
+        pool_name="mypool",
+        # БД нужна только основному процессу: чтение компаний и поток записи, плюс запас
+        pool_size=3,
+        # Без COM_RESET_CONNECTION при каждом возврате соединения в пул
+        pool_reset_session=False,
+        host=CONFIG['DB_HOST'],
+        user=CONFIG['DB_USER'],
+        password=CONFIG['DB_PASSWORD'],
+        database=CONFIG['DB_NAME'],
+        autocommit=False
+    )
+
 
 @contextmanager
 def get_db_connection():
     try:
-        connection_pool = pooling.MySQLConnectionPool(
-            pool_name="mypool",
-            pool_size=5,
-            host=CONFIG['DB_HOST'],
-            user=CONFIG['DB_USER'],
-            password=CONFIG['DB_PASSWORD'],
-            database=CONFIG['DB_NAME']
-        )
-        conn = connection_pool.get_connection()
+        conn = get_connection_pool(os.getpid()).get_connection()
         yield conn
     except Error as e:
         logging.error(f"Database error: {e}")
@@ -133,90 +203,256 @@ def get_db_connection():
             conn.close()
 
 
-@contextmanager
-def get_webdriver():
+# Браузер воркера: один на процесс, пересоздаётся каждые MAX_PAGES_PER_DRIVER страниц
+_driver = None
+_driver_pages = 0
+
+
+def create_webdriver():
     options = webdriver.ChromeOptions()
     options.add_argument("--headless")
     options.add_argument("--disable-gpu")
     options.add_argument("--no-sandbox")
-    driver = None
-    try:
+    # driver.get возвращается по DOMContentLoaded, не дожидаясь картинок и стилей
+    options.page_load_strategy = 'eager'
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    # Нужен только текст: картинки и уведомления не загружаем
+    options.add_experimental_option('prefs', {
+        'profile.managed_default_content_settings.images': 2,
+        'profile.default_content_setting_values.notifications': 2
+    })
+    if CONFIG['SE_GRID_URL']:
+        driver = webdriver.Remote(command_executor=CONFIG['SE_GRID_URL'], options=options)
+    else:
         driver = webdriver.Chrome(options=options)
-        yield driver
+    driver.set_page_load_timeout(CONFIG['PAGE_LOAD_TIMEOUT'])
+    return driver
+
+
+def quit_webdriver():
+    global _driver, _driver_pages
+    if _driver:
+        try:
+            _driver.quit()
+        except WebDriverException as e:
+            logging.error(f"WebDriver quit error: {e}")
+    _driver = None
+    _driver_pages = 0
+
+
+# Инициализация процесса пула, выполняется один раз на воркер
+def init_worker(config):
+    # Настройки как у родителя. При fork CONFIG уже унаследован, при spawn модуль
+    # импортируется заново и собирает CONFIG из окружения, значения родителя его перекрывают
+    CONFIG.update(config)
+    # Chrome запускается только при первой странице, которой нужен браузер
+    util.Finalize(None, quit_webdriver, exitpriority=10)
+
+
+@contextmanager
+def get_webdriver():
+    global _driver, _driver_pages
+    try:
+        if _driver is None:
+            _driver = create_webdriver()
+        yield _driver
     except WebDriverException as e:
         logging.error(f"WebDriver error: {e}")
+        # Браузер мог упасть, следующая страница получит новый
+        quit_webdriver()
         raise
     finally:
-        if driver:
-            driver.quit()
+        if _driver:
+            _driver_pages += 1
+            if _driver_pages >= CONFIG['MAX_PAGES_PER_DRIVER']:
+                quit_webdriver()
+            else:
+                try:
+                    _driver.delete_all_cookies()
+                except WebDriverException:
+                    quit_webdriver()
+
+
+# Сбор текста из div и p без браузера
+class TextExtractor(HTMLParser):
+    """Незакрытый <p> закрывается следующим блочным тегом или концом родителя,
+    как в браузере, и не захватывает остаток документа:
+
+    >>> extractor = TextExtractor()
+    >>> extractor.feed('<div><p>e<p>f</div>g<h1>h</h1><p>i<ul><li>j</li></ul>')
+    >>> extractor.get_text()
+    'e f i'
+    >>> extractor = TextExtractor()
+    >>> extractor.feed('<p>e<p>f</div>g')
+    >>> extractor.get_text()
+    'e f'
+    """
+    TEXT_TAGS = {'div', 'p'}
+    SKIP_TAGS = {'script', 'style', 'noscript', 'template'}
+    # Блочные теги: их начало и конец закрывают открытый <p>
+    BLOCK_TAGS = {
+        'address', 'article', 'aside', 'blockquote', 'body', 'dd', 'details', 'dialog',
+        'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form',
+        'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'html', 'li',
+        'main', 'menu', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul'
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.open_tags = []
+        self.skip_depth = 0
+        self.chunks = []
+
+    def close_paragraph(self):
+        while self.open_tags and self.open_tags[-1] == 'p':
+            self.open_tags.pop()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.close_paragraph()
+        if tag in self.TEXT_TAGS:
+            self.open_tags.append(tag)
+        elif tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.TEXT_TAGS:
+            # Закрывающий тег закрывает и все незакрытые внутри него <p>,
+            # лишний </div> без пары - хотя бы открытый <p>
+            if tag in self.open_tags:
+                while self.open_tags.pop() != tag:
+                    pass
+            else:
+                self.close_paragraph()
+        elif tag in self.BLOCK_TAGS:
+            self.close_paragraph()
+        elif tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        data = data.strip()
+        if data and self.open_tags and not self.skip_depth:
+            self.chunks.append(data)
+
+    def get_text(self):
+        return ' '.join(self.chunks)
+
+
+# Страница отрисована на сервере: в div и p достаточно текста без выполнения JS
+def is_static_page(extractor):
+    return (len(extractor.chunks) >= STATIC_FETCH['MIN_TEXT_BLOCKS']
+            and len(extractor.get_text()) >= STATIC_FETCH['MIN_TEXT_LENGTH'])
+
+
+# Чтение тела ответа не дольше deadline: таймаут сокета не спасает от сервера,
+# который отдаёт данные по байту. None - если загрузка не уложилась в срок
+def read_body(response, deadline):
+    body = bytearray()
+    while len(body) < STATIC_FETCH['MAX_BYTES']:
+        if time.monotonic() > deadline:
+            return None
+        chunk = response.read1(min(STATIC_FETCH['READ_CHUNK'], STATIC_FETCH['MAX_BYTES'] - len(body)))
+        if not chunk:
+            break
+        body += chunk
+    return bytes(body)
+
+
+# Загрузка страницы обычным HTTP-запросом, None - если нужен браузер
+def fetch_static_text(url):
+    deadline = time.monotonic() + STATIC_FETCH['TOTAL_TIMEOUT']
+    try:
+        request = Request(url, headers=STATIC_FETCH['HEADERS'])
+        with urlopen(request, timeout=STATIC_FETCH['TIMEOUT']) as response:
+            content_type = response.headers.get_content_type()
+            if content_type not in STATIC_FETCH['CONTENT_TYPES']:
+                logging.info(f"Unexpected content type {content_type} for {url}")
+                return None
+
+            charset = response.headers.get_content_charset() or 'utf-8'
+            body = read_body(response, deadline)
+            if body is None:
+                logging.info(f"Static fetch too slow for {url}")
+                return None
+            html = body.decode(charset, errors='replace')
+    except (OSError, ValueError, LookupError, HTTPException) as e:
+        logging.info(f"Static fetch failed for {url}: {e}")
+        return None
+
+    extractor = TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+
+    if not is_static_page(extractor):
+        logging.info(f"Falling back to browser for {url}")
+        return None
+    return extractor.get_text()
 
 
-# Получение списка ссылок
+# Получение списка ссылок: строки отдаются по мере чтения из БД
 def fetch_companies():
     try:
         with get_db_connection() as conn:
-            with conn.cursor() as cursor:
+            with conn.cursor(buffered=False) as cursor:
                 cursor.execute(QUERIES['select_company'], (CONFIG['BATCH_SIZE'],))
-                return cursor.fetchall()
+                yield from cursor
     except Error as e:
         logging.error(f"Error fetching companies: {e}")
-        return []
 
 
 # Парсинг данных о компании
-def parse_company(company_data, result_queue):
+def parse_company(company_data):
     company_id, url = company_data
     try:
-        with get_webdriver() as driver:
-            driver.get(url)
-
-            WebDriverWait(driver, 10).until(
-                ec.presence_of_element_located((By.TAG_NAME, 'body'))
-            )
-
-            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-
-            # Сбор текста
-            elements = driver.find_elements(By.XPATH, '//div | //p')
-            text = ' '.join(el.text for el in elements if el.text.strip())
-
-            # Очистка текста
-            text = text.replace('"', '').replace("'", '').strip()
-
-            result_queue.put((text, company_id))
-            logging.info(f"Processed company ID: {company_id}")
-
+        # Статические сайты обходятся без запуска Chrome
+        text = fetch_static_text(url)
+
+        if text is None:
+            with get_webdriver() as driver:
+                try:
+                    driver.get(url)
+                except TimeoutException:
+                    # Медленный сайт: останавливаем загрузку и берём то, что успело загрузиться
+                    logging.info(f"Page load timeout for {url}, using partial page")
+                    driver.execute_script("window.stop();")
+
+                # Сбор текста одним вызовом вместо запроса к chromedriver на каждый элемент
+                text = driver.execute_script(EXTRACT_TEXT_SCRIPT) or ''
+
+        # Очистка текста
+        text = text.translate(QUOTE_TABLE).strip()
+
+        logging.info(f"Processed company ID: {company_id}")
+        return text, company_id
+
+    except TimeoutException as e:
+        # Завис рендерер страницы: браузер уже пересоздан, пустой текст не сохраняется,
+        # и компания будет обработана при следующем запуске
+        logging.error(f"Script timeout for {url}: {e}")
+        return '', company_id
     except Exception as e:
         logging.error(f"Error processing {url}: {e}")
-        result_queue.put(("ERROR", company_id))
+        return "ERROR", company_id
 
 
 # Обработка текста с помощью ChatGPT
-def process_with_chatgpt(text):
+async def process_with_chatgpt(client, semaphore, text):
     if not text or text == "ERROR":
         return None
 
     try:
-        client = OpenAI(api_key=CONFIG['OPENAI_API_KEY'])
-
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system",
-                 "content": "You are a helpful assistant that provides concise business descriptions."},
-                {"role": "user", "content": f"""
-                Analyze this company information and provide:
-                #Description# - Brief company overview
-                #Target Audience# - Who they serve
-                #Market Problem# - Problem they solve
-                #Product# - Their product/service
-                #Business Model# - One of: {', '.join(KEYWORDS['business_models'])}
-                #Industry# - One of: {', '.join(KEYWORDS['industries'][:5])}...
-                Text to analyze: {text[:3000]}
-                """}
-            ],
-            max_tokens=500
-        )
+        async with semaphore:
+            response = await client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system",
+                     "content": "You are a helpful assistant that provides concise business descriptions."},
+                    {"role": "user", "content": PROMPT.format(text=text[:3000])}
+                ],
+                max_tokens=500
+            )
 
         return response.choices[0].message.content
     except Exception as e:
@@ -224,61 +460,172 @@ def process_with_chatgpt(text):
         return None
 
 
+# Клиент OpenAI создаётся один раз на цикл событий потока записи и переиспользует
+# HTTP-соединения между пачками. Цикл в ключе кэша: соединения привязаны к нему
+@lru_cache(maxsize=1)
+def get_openai_client(loop):
+    return AsyncOpenAI(api_key=CONFIG['OPENAI_API_KEY'])
+
+
+async def close_openai_client():
+    if get_openai_client.cache_info().currsize:
+        await get_openai_client(asyncio.get_running_loop()).close()
+        get_openai_client.cache_clear()
+
+
+async def process_batch_with_chatgpt_async(texts):
+    client = get_openai_client(asyncio.get_running_loop())
+    semaphore = asyncio.Semaphore(CONFIG['OPENAI_MAX_CONCURRENCY'])
+    return await asyncio.gather(
+        *(process_with_chatgpt(client, semaphore, text) for text in texts)
+    )
+
+
+# Параллельная обработка пачки текстов, результаты в том же порядке
+def process_batch_with_chatgpt(runner, texts):
+    try:
+        return runner.run(process_batch_with_chatgpt_async(texts))
+    except Exception as e:
+        logging.error(f"ChatGPT error: {e}")
+        return [None] * len(texts)
+
+
+# Запись пачки результатов в БД одной транзакцией
+def flush_results(buffer, runner):
+    if not buffer:
+        return
+
+    # Обработка через ChatGPT
+    # processed_texts = process_batch_with_chatgpt(runner, [text for text, _ in buffer])
+    processed_texts = [text for text, _ in buffer]  # Заглушка
+
+    rows = [
+        (processed_text, company_id)
+        for processed_text, (_, company_id) in zip(processed_texts, buffer)
+        if processed_text
+    ]
+
+    try:
+        if rows:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.executemany(QUERIES['update_company'], rows)
+                    conn.commit()
+                    logging.info(f"Updated {len(rows)} companies")
+    except Exception as e:
+        company_ids = ', '.join(str(company_id) for _, company_id in buffer)
+        logging.error(f"Error saving companies {company_ids}: {e}")
+    finally:
+        buffer.clear()
+
+
 # Запись результатов в БД
 def save_results(result_queue):
-    while True:
-        item = result_queue.get()
-        if item == "STOP":
-            break
+    buffer = []
+    last_flush = time.monotonic()
 
-        text, company_id = item
+    # Один цикл событий на всё время работы потока: клиент OpenAI живёт на нём
+    with asyncio.Runner() as runner:
+        while True:
+            timeout = max(0, SAVE_BATCH['FLUSH_INTERVAL'] - (time.monotonic() - last_flush))
+            try:
+                item = result_queue.get(timeout=timeout)
+            except Empty:
+                # Основной поток завершился, не отправив STOP: дописываем накопленное и выходим
+                if not main_thread().is_alive():
+                    break
+                item = None
 
-        # Обработка через ChatGPT
-        # processed_text = process_with_chatgpt(text)
-        processed_text = text  # Заглушка
+            if item == "STOP":
+                break
 
-        if processed_text:
-            try:
-                with get_db_connection() as conn:
-                    with conn.cursor() as cursor:
-                        cursor.execute(QUERIES['update_company'], (processed_text, company_id))
-                        conn.commit()
-                        logging.info(f"Updated company ID: {company_id}")
-            except Error as e:
-                logging.error(f"Error saving company {company_id}: {e}")
+            if item:
+                buffer.append(item)
 
+            if (len(buffer) >= SAVE_BATCH['SIZE']
+                    or time.monotonic() - last_flush >= SAVE_BATCH['FLUSH_INTERVAL']):
+                flush_results(buffer, runner)
+                last_flush = time.monotonic()
 
-def main():
-    companies = fetch_companies()
-    if not companies:
-        logging.warning("No companies to process")
-        return
+        flush_results(buffer, runner)
+        runner.run(close_openai_client())
 
-    result_queue = Queue()
 
-    # Сохранение результатов
-    saver_process = Process(target=save_results, args=(result_queue,))
-    saver_process.start()
+# Передача результата потоку записи. Ждём, пока в очереди есть место,
+# но не вечно: если поток записи упал, очередь больше никто не разберёт
+def put_result(result_queue, saver_thread, item):
+    while True:
+        try:
+            result_queue.put(item, timeout=1)
+            return
+        except Full:
+            if not saver_thread.is_alive():
+                raise RuntimeError("Result saver stopped, results can't be saved")
+
+
+# Обработка компаний пулом постоянных процессов: воркеры переиспользуются между
+# компаниями, а медленный сайт не задерживает остальных. Строки читаются из курсора
+# по мере освобождения места: в работе не больше max_pending компаний одновременно.
+# Если процесс воркера погиб (OOM, segfault), пул сломан целиком: он пересоздаётся,
+# а незавершённые компании остаются с пустым описанием до следующего запуска
+def process_companies(companies, result_queue, saver_thread):
+    max_pending = 2 * CONFIG['MAX_THREADS']
+    processed = 0
 
-    # Обработка в несколько параллельных процессов
-    processes = []
-    for company in companies:
-        p = Process(target=parse_company, args=(company, result_queue))
-        processes.append(p)
-        p.start()
+    while True:
+        broken = False
+        with ProcessPoolExecutor(max_workers=CONFIG['MAX_THREADS'],
+                                 initializer=init_worker, initargs=(CONFIG,)) as executor:
+            pending = {executor.submit(parse_company, company)
+                       for company in islice(companies, max_pending)}
+
+            while pending and not broken:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        continue
+                    put_result(result_queue, saver_thread, result)
+                    processed += 1
+
+                if not broken:
+                    for company in islice(companies, len(done)):
+                        pending.add(executor.submit(parse_company, company))
+
+        if not broken:
+            return processed
+
+        logging.error("Worker process died, restarting the pool; "
+                      "unfinished companies are left for the next run")
 
-        # Ограничение количества одновременных процессов
-        if len(processes) >= CONFIG['MAX_THREADS']:
-            for p in processes:
-                p.join()
-            processes = []
 
-    # Ожидание оставшихся процессов
-    for p in processes:
-        p.join()
+def main():
+    # Ограниченная очередь: если запись в БД отстаёт, основной поток ждёт на put
+    # и не отправляет в пул новые компании
+    result_queue = Queue(maxsize=2 * CONFIG['MAX_THREADS'])
 
-    result_queue.put("STOP")
-    saver_process.join()
+    # Сохранение результатов в потоке основного процесса: запись в БД - чистый I/O,
+    # а тексты не приходится повторно сериализовать для отдельного процесса
+    saver_thread = Thread(target=save_results, args=(result_queue,))
+    saver_thread.start()
+
+    processed = 0
+    companies = fetch_companies()
+    try:
+        processed = process_companies(companies, result_queue, saver_thread)
+    finally:
+        companies.close()
+        # STOP отправляется при любом исходе, иначе поток записи не завершится
+        # и процесс не выйдет
+        if saver_thread.is_alive():
+            put_result(result_queue, saver_thread, "STOP")
+        saver_thread.join()
+
+    if not processed:
+        logging.warning("No companies to process")
+        return
 
     logging.info("Processing completed")
 